@@ -1,10 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import pandas as pd
-import hdbscan
-from sklearn.preprocessing import StandardScaler, RobustScaler
-from sklearn.cluster import KMeans
 
 __author__ = "Daniel Hannah"
 __email__ = "dan@danhannah.site"
@@ -19,6 +15,9 @@ there are plans to implement other outlier detection methods based on:
 This class will also eventually include probabilistic schemes for estimating
 how likely it is that a particular point is an outlier.
 
+Pandas, scikit-learn and hdbscan are imported where they are used, so code
+paths that never cluster do not pay for loading them.
+
 """
 
 
@@ -70,7 +69,7 @@ class AnomalyDetector:
             data_list.append(self.d_f[self.response_var].values)
         return np.matrix(list(zip(*data_list)))
 
-    def scale_data(self, method=StandardScaler()):
+    def scale_data(self, method=None):
         """Scales the data prior to analysis.
 
         Args:
@@ -80,6 +79,9 @@ class AnomalyDetector:
             A scaled numpy data matrix.
 
         """
+        if method is None:
+            from sklearn.preprocessing import StandardScaler
+            method = StandardScaler()
         return method.fit_transform(self.data_matrix)
 
     def get_most_frequent(self, threshold):
@@ -105,6 +107,7 @@ class AnomalyDetector:
             print("Outlier metrics must be calculated prior to grouping.")
             return
         else:
+            import pandas as pd
             suspect_dict = {}
             for row_tuple in self.d_f.iterrows():
                 row = row_tuple[1]
@@ -133,7 +136,11 @@ class AnomalyDetector:
                            suspect_dict[row["npi"]]["total_num_proc"]
                 suspect_dict[row["npi"]]["outlier_count_rate"] = new_rate
             suspect_d_f = pd.DataFrame.from_dict(suspect_dict, orient='index')
-            worst = suspect_d_f.sort_values(by="outlier_count", ascending=False)
+            # Ties (often providers with no outliers at all) are broken by
+            # rate, cost and finally NPI so that rankings are reproducible.
+            worst = suspect_d_f.sort_index().sort_values(
+                by=["outlier_count", "outlier_count_rate", "cost_to_medicare"],
+                ascending=False, kind='mergesort')
 
             return worst
 
@@ -197,6 +204,7 @@ class KMeansAnomalyDetector(AnomalyDetector):
             A k-means clustered data set (KMeans)
 
         """
+        from sklearn.cluster import KMeans
         return KMeans(init=method, n_clusters=num_clusters).fit(self.scaled_dm)
 
     def assign_clusters(self, clustered_data):
@@ -295,6 +303,7 @@ class HDBAnomalyDetector(AnomalyDetector):
             A fit from an HDBSCAN clusterer.
 
         """
+        import hdbscan
         return hdbscan.HDBSCAN(min_cluster_size=min_size).fit(self.scaled_dm)
 
     def get_outlier_scores(self, min_size):
@@ -332,3 +341,219 @@ class HDBAnomalyDetector(AnomalyDetector):
         return super().get_most_frequent(threshold)
 
 
+class StratifiedAnomalyDetector(AnomalyDetector):
+    """Outlier detection run separately within each HCPCS stratum.
+
+    Procedures with very different billing scales (an office visit and an
+    injection, say) end up in the same fit when a whole specialty is clustered
+    at once. This detector partitions the data by HCPCS code, or by code
+    family (the first few characters of the code), fits an HDBSCAN or k-means
+    detector per stratum in parallel, and converts each stratum's raw outlier
+    metric to a percentile rank so that the metrics are comparable when they
+    are merged back into the per-NPI tally.
+
+    Attributes:
+        regression_vars (list): List of labels for regression variables.
+        response_var (str): Label for the response variable.
+        d_f (DataFrame): A Pandas dataframe containing queried data.
+        use_response_var (Boolean): Use response variable in clustering?
+        stratum_labels (Series): The stratum each record belongs to.
+        min_stratum_size (int): Smallest stratum that gets its own fit.
+
+    """
+
+    def __init__(self, regression_vars, response_var, d_f, use_response_var,
+                 strata_col='hcpcs_code', prefix_len=None,
+                 min_stratum_size=50):
+        """Initialization for StratifiedAnomalyDetector.
+
+        Args:
+            regression_vars (list): A list of strings for regression variables.
+            response_var (str): Label for the response variable for regression.
+            d_f (DataFrame): A Pandas DataFrame containing queried data.
+            use_response_var (Boolean): Use response variable in clustering?
+            strata_col (str): Column holding the procedure code.
+            prefix_len (int): Stratify by the first prefix_len characters of
+                the code (a code family); None uses the full code.
+            min_stratum_size (int): Strata smaller than this are pooled into
+                a single "other" stratum.
+
+        """
+        # The parent initializer is skipped on purpose: the full-slice data
+        # matrix it builds is never used, as each stratum builds its own.
+        self.regression_vars = regression_vars
+        self.response_var = response_var
+        self.d_f = d_f
+        self.use_response_var = use_response_var
+        codes = self.d_f[strata_col].astype(str)
+        if prefix_len is not None:
+            codes = codes.str[:prefix_len]
+        sizes = codes.value_counts()
+        small = sizes.index[sizes < min_stratum_size]
+        self.stratum_labels = codes.where(~codes.isin(small), 'other')
+        self.min_stratum_size = min_stratum_size
+
+    def get_outlier_scores(self, det_config, n_jobs=1):
+        """Fits a detector per stratum and stores normalized outlier metrics.
+
+        The raw metric of each stratum goes into "raw_outlier_metric" and its
+        within-stratum percentile rank (between 0 and 1) into
+        "outlier_metric". A pooled stratum that is still too small to fit is
+        given a metric of zero.
+
+        Args:
+            det_config (dict): Base detector configuration (see run_detector).
+            n_jobs (int): Number of worker processes; 1 fits the strata in
+                this process and None uses all cores.
+
+        Returns:
+            None
+
+        """
+        import pandas as pd
+
+        needed = list(self.regression_vars) + [self.response_var, 'npi']
+        strata = self.stratum_labels.groupby(self.stratum_labels).groups
+        groups = [(label, idx) for label, idx in strata.items()
+                  if len(idx) >= self.min_stratum_size]
+
+        raw = pd.Series(np.nan, index=self.d_f.index)
+        normalized = pd.Series(0.0, index=self.d_f.index)
+        args = [(self.d_f.loc[idx, needed], det_config, self.regression_vars,
+                 self.response_var) for _, idx in groups]
+        if n_jobs == 1 or len(args) <= 1:
+            results = [score_stratum(*arg) for arg in args]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(score_stratum, *zip(*args)))
+        for (_, idx), result in zip(groups, results):
+            metrics = pd.Series(result, index=idx)
+            raw[idx] = metrics
+            normalized[idx] = metrics.rank(pct=True)
+        self.d_f['raw_outlier_metric'] = raw
+        self.d_f['outlier_metric'] = normalized
+        return
+
+    def get_most_frequent(self, threshold=None, percent=2):
+        """Tallies the top percent of each stratum as outliers.
+
+        Args:
+            threshold (float): Cutoff in normalized metric (overrides percent).
+            percent (float): Top N% of each stratum are outliers.
+
+        Returns:
+            A Pandas DataFrame which is a subset of the larger dataframe.
+
+        """
+        if threshold is None:
+            threshold = 1 - percent / 100.0
+        return super().get_most_frequent(threshold)
+
+
+def config_label(det_config):
+    """Builds a short, file-name-safe label for a detector configuration.
+
+    The label is also used as the suffix of the outlier count table names, so
+    decimal points are spelled as "p" to keep it a valid SQL identifier.
+
+    Args:
+        det_config (dict): A detector configuration (see run_detector).
+
+    Returns:
+        A string such as "hdb_min_size15_percent2".
+
+    """
+    params = sorted(key for key in det_config if key != 'detector')
+    return det_config['detector'] + "".join(
+        "_" + key + str(det_config[key]).replace('.', 'p') for key in params)
+
+
+def fit_detector(d_f, det_config, regression_vars, response_var):
+    """Builds a configured detector and computes its outlier metrics.
+
+    Args:
+        d_f (DataFrame): A Pandas DataFrame containing queried data.
+        det_config (dict): The detector configuration (see run_detector).
+        regression_vars (list): A list of strings for regression variables.
+        response_var (str): Label for the response variable for regression.
+
+    Returns:
+        The detector, with "outlier_metric" populated in its dataframe.
+
+    """
+    use_response = det_config.get('use_response_var', True)
+    if det_config['detector'] == 'hdb':
+        detector = HDBAnomalyDetector(regression_vars, response_var, d_f,
+                                      use_response)
+        detector.get_outlier_scores(min_size=det_config.get('min_size', 15))
+    elif det_config['detector'] == 'kmeans':
+        detector = KMeansAnomalyDetector(regression_vars, response_var, d_f,
+                                         use_response)
+        detector.compute_centroid_distances(det_config.get('num_clusters', 8))
+    else:
+        raise ValueError("Unknown detector: " + str(det_config['detector']))
+    return detector
+
+
+def score_stratum(d_f, det_config, regression_vars, response_var):
+    """Raw outlier metrics for one stratum (run in a worker process).
+
+    Args:
+        d_f (DataFrame): The records of a single stratum.
+        det_config (dict): The detector configuration (see run_detector).
+        regression_vars (list): A list of strings for regression variables.
+        response_var (str): Label for the response variable for regression.
+
+    Returns:
+        A Numpy array of outlier metrics in the order of the records.
+
+    """
+    detector = fit_detector(d_f.copy(), det_config, regression_vars,
+                            response_var)
+    return detector.d_f['outlier_metric'].values
+
+
+def run_detector(d_f, det_config, regression_vars, response_var, n_jobs=1):
+    """Scores a slice with a configured detector and tallies outliers by NPI.
+
+    The configuration is a plain dictionary so that it can be pickled and
+    shipped to worker processes. The "detector" key selects the algorithm
+    ("hdb" or "kmeans"); "min_size" (HDBSCAN) or "num_clusters" (k-means) and
+    "percent" are passed through to the detector, and "use_response_var"
+    defaults to True as in the notebooks. Setting "stratify" to "code" or
+    "family" fits the detector per HCPCS code or per code family (the first
+    "prefix_len" characters, three by default) instead.
+
+    Args:
+        d_f (DataFrame): A Pandas DataFrame containing queried data.
+        det_config (dict): The detector configuration.
+        regression_vars (list): A list of strings for regression variables.
+        response_var (str): Label for the response variable for regression.
+        n_jobs (int): Worker processes for stratified fits (1 fits inline).
+
+    Returns:
+        A Pandas DataFrame of providers sorted by outlier count.
+
+    """
+    default_percent = 2 if det_config['detector'] == 'hdb' else 10
+    percent = det_config.get('percent', default_percent)
+    stratify = det_config.get('stratify')
+    if stratify is None:
+        detector = fit_detector(d_f, det_config, regression_vars,
+                                response_var)
+        return detector.get_most_frequent(percent=percent)
+    elif stratify in ('code', 'family'):
+        prefix_len = None
+        if stratify == 'family':
+            prefix_len = det_config.get('prefix_len', 3)
+        detector = StratifiedAnomalyDetector(
+            regression_vars, response_var, d_f,
+            det_config.get('use_response_var', True), prefix_len=prefix_len,
+            min_stratum_size=det_config.get('min_stratum_size', 50))
+        base_config = {key: val for key, val in det_config.items() if key not
+                       in ('stratify', 'prefix_len', 'min_stratum_size')}
+        detector.get_outlier_scores(base_config, n_jobs=n_jobs)
+        return detector.get_most_frequent(percent=percent)
+    else:
+        raise ValueError("Unknown stratification: " + str(stratify))
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+import pandas as pd
+from anomaly_tools import run_detector, config_label
+from database_tools import CMSDBReader, PandasDBReader, OutlierCountDBWriter
+from partition_tools import PartitionStore
+from fh_config import regional_options, specialty_options, regression_vars, \
+    response_var
+
+__author__ = "Daniel Hannah"
+__email__ = "dan@danhannah.site"
+
+"""Sharded batch scoring of the CMS data across several worker nodes.
+
+A full refresh is broken into (state, specialty, metric) work units which are
+put on a shared queue, where each metric is one of the served outlier count
+tables listed under served_metrics in config.yaml together with the detector
+configuration behind it. Any number of workers, on any number of machines,
+claim units from the queue, score them and write the outlier counts into the
+provider_anomaly_counts_<metric> tables. Writes replace the whole slice, so a
+unit that is scored twice leaves the same result behind.
+
+The queue is pluggable: WorkQueue defines the interface, PostgresWorkQueue
+shares the work through the PostgreSQL server that already holds the data, and
+SQLiteWorkQueue is a single-file stand-in for local testing. Workers renew the
+lease on their unit while it is being scored; units claimed by a worker which
+then died are handed out again once the lease expires, and failed units are
+retried (after a delay) up to a limit, so re-running the workers resumes a
+partially finished refresh. The "retry" command hands units that ran out of
+attempts back to the workers, and "reset" does the same for every finished
+unit so that a queue can be used for another full refresh.
+
+Unit IDs include the label of the detector configuration, so editing a config
+under served_metrics queues its tables again on the next enqueue. When release
+years are given, units are made per (year, state, specialty) partition and
+their IDs also include a fingerprint of the partition's rows. Adding a new year
+or reloading an old one therefore only queues the partitions that actually
+changed; everything else is already marked done in the queue. Units whose
+partition has changed again since they were queued are cancelled rather than
+scored, as a newer unit covers the current rows.
+
+"""
+
+
+def served_metrics(config_yaml):
+    """Reads the served outlier count tables and their detector configs.
+
+    Args:
+        config_yaml (str): Path to the database configuration yaml.
+
+    Returns:
+        A dictionary mapping table suffixes to detector configurations.
+
+    """
+    with open(config_yaml, 'r') as f:
+        return yaml.safe_load(f).get('served_metrics') or {}
+
+
+def make_units(states, specialties, metrics, years=None, config_yaml=None):
+    """Builds the work units for a batch refresh.
+
+    Args:
+        states (list): Two-letter state codes.
+        specialties (list): Provider types.
+        metrics (dict): Maps outlier count table suffixes to detector
+            configurations (see served_metrics).
+        years (list): CMS release years; None scores the original table.
+        config_yaml (str): Database configuration, needed to fingerprint the
+            partitions when years are given.
+
+    Returns:
+        A list of work unit dictionaries.
+
+    """
+    reader = CMSDBReader(config_yaml) if years else None
+    units = []
+    for year in (years or [None]):
+        for state in states:
+            for specialty in specialties:
+                id_parts = [state, specialty]
+                fprint = None
+                if year is not None:
+                    fprint = reader.slice_fingerprint([state], [specialty],
+                                                      year=year)
+                    id_parts = [str(year)] + id_parts + [fprint]
+                for metric in sorted(metrics):
+                    label = config_label(metrics[metric])
+                    units.append({
+                        'unit_id': "|".join(id_parts + [metric, label]),
+                        'year': year,
+                        'state': state,
+                        'specialty': specialty,
+                        'metric': metric,
+                        'config': metrics[metric],
+                        'fingerprint': fprint
+                    })
+    return units
+
+
+class WorkQueue:
+    """General work queue class; not for direct use.
+
+    Subclasses store units with a status of "pending", "running", "done",
+    "failed" or "cancelled" and must implement the methods below. A running
+    unit whose lease has not been renewed for lease_seconds is considered
+    abandoned and may be claimed again. Only the worker holding a unit may
+    renew, complete, fail or cancel it.
+
+    Attributes:
+        lease_seconds (float): How long a claim lasts without renewal.
+        max_attempts (int): How many times a unit is tried before giving up.
+        retry_seconds (float): Delay before a failed unit is retried, scaled
+            by the number of attempts so far.
+
+    """
+
+    def __init__(self, lease_seconds=600, max_attempts=3, retry_seconds=60):
+        """Initialization for all of the work queues.
+
+        Args:
+            lease_seconds (float): How long a claim lasts without renewal.
+            max_attempts (int): How many times a unit is tried.
+            retry_seconds (float): Base delay before a failed unit is retried.
+
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+
+    def put(self, units):
+        """Adds work units, ignoring any that are already queued."""
+        raise NotImplementedError
+
+    def claim(self, worker_id):
+        """Reserves the next available unit, or returns None if none are."""
+        raise NotImplementedError
+
+    def renew(self, unit_id, worker_id):
+        """Extends a claim; returns False if the worker no longer holds it."""
+        raise NotImplementedError
+
+    def complete(self, unit_id, worker_id):
+        """Marks a unit held by this worker as done."""
+        raise NotImplementedError
+
+    def fail(self, unit_id, worker_id, error):
+        """Records a failure; the unit is retried until max_attempts."""
+        raise NotImplementedError
+
+    def cancel(self, unit_id, worker_id, reason):
+        """Gives up on a unit held by this worker that no longer applies."""
+        raise NotImplementedError
+
+    def reset(self, statuses=('done', 'failed')):
+        """Requeues units with these statuses; returns how many were reset."""
+        raise NotImplementedError
+
+    def status_counts(self):
+        """Returns a dictionary mapping each status to its number of units."""
+        raise NotImplementedError
+
+
+class SQLWorkQueue(WorkQueue):
+    """Work queue stored in a table of a DB-API database.
+
+    The SQL is shared by the SQLite and PostgreSQL queues; subclasses supply
+    the connection, the parameter placeholder and the claim statement.
+
+    Attributes:
+        connection: A DB-API database connection.
+        table (str): Name of the work unit table.
+
+    """
+
+    placeholder = "?"
+
+    def __init__(self, connection, table='scoring_units', create_table=True,
+                 **kwargs):
+        """Initialization for the SQL-backed queues.
+
+        Args:
+            connection: A DB-API database connection.
+            table (str): Name of the work unit table.
+            create_table (Boolean): Create the table if it is missing? Extra
+                connections to an existing queue can skip this.
+
+        """
+        super().__init__(**kwargs)
+        self.connection = connection
+        self.table = table
+        if not create_table:
+            return
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS " + self.table + " (unit_id TEXT "
+            "PRIMARY KEY, year INTEGER, state TEXT, specialty TEXT, "
+            "config TEXT, fingerprint TEXT, metric TEXT, "
+            "status TEXT, worker TEXT, attempts INTEGER, error TEXT, "
+            "claimed_at DOUBLE PRECISION, not_before DOUBLE PRECISION)")
+        self.connection.commit()
+
+    def sql(self, statement):
+        """Swaps the "?" placeholders for the ones this database expects."""
+        return statement.replace("?", self.placeholder)
+
+    def put(self, units):
+        cursor = self.connection.cursor()
+        for unit in units:
+            cursor.execute(self.sql(
+                "INSERT INTO " + self.table + " (unit_id, year, state, "
+                "specialty, config, fingerprint, metric, status, attempts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', 0) "
+                "ON CONFLICT (unit_id) DO NOTHING"),
+                (unit['unit_id'], unit.get('year'), unit['state'],
+                 unit['specialty'], json.dumps(unit['config'], sort_keys=True),
+                 unit.get('fingerprint'), unit['metric']))
+        self.connection.commit()
+
+    def claimable(self):
+        """SQL condition selecting units that may be handed to a worker."""
+        return ("(status = 'pending' OR (status = 'running' AND "
+                "claimed_at < ?)) AND attempts < ? AND "
+                "(not_before IS NULL OR not_before <= ?)")
+
+    # Fresh units go first and retried ones last.
+    claim_order = " ORDER BY attempts, unit_id LIMIT 1"
+
+    def expire(self):
+        """SQL statement failing abandoned units that are out of attempts."""
+        return ("UPDATE " + self.table + " SET status = 'failed', error = "
+                "'lease expired' WHERE status = 'running' AND claimed_at < ? "
+                "AND attempts >= ?")
+
+    def claim(self, worker_id):
+        raise NotImplementedError
+
+    def renew(self, unit_id, worker_id):
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET claimed_at = ? WHERE unit_id = ? "
+            "AND worker = ? AND status = 'running'"),
+            (time.time(), unit_id, worker_id))
+        self.connection.commit()
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker_id):
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET status = 'done', error = NULL "
+            "WHERE unit_id = ? AND worker = ? AND status = 'running'"),
+            (unit_id, worker_id))
+        self.connection.commit()
+
+    def fail(self, unit_id, worker_id, error):
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET status = CASE WHEN attempts < ? "
+            "THEN 'pending' ELSE 'failed' END, error = ?, "
+            "not_before = ? + ? * attempts "
+            "WHERE unit_id = ? AND worker = ? AND status = 'running'"),
+            (self.max_attempts, str(error), time.time(), self.retry_seconds,
+             unit_id, worker_id))
+        self.connection.commit()
+
+    def cancel(self, unit_id, worker_id, reason):
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET status = 'cancelled', error = ? "
+            "WHERE unit_id = ? AND worker = ? AND status = 'running'"),
+            (reason, unit_id, worker_id))
+        self.connection.commit()
+
+    def reset(self, statuses=('done', 'failed')):
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET status = 'pending', worker = NULL, "
+            "attempts = 0, error = NULL, claimed_at = NULL, not_before = NULL "
+            "WHERE status IN (" + ", ".join(["?"] * len(statuses)) + ")"),
+            tuple(statuses))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def status_counts(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM " + self.table +
+                       " GROUP BY status")
+        return dict(cursor.fetchall())
+
+    columns = "unit_id, year, state, specialty, config, fingerprint, metric"
+
+    def unit_from_row(self, row):
+        """Converts a claimed row (in the order of columns) to a unit."""
+        return {'unit_id': row[0], 'year': row[1], 'state': row[2],
+                'specialty': row[3], 'config': json.loads(row[4]),
+                'fingerprint': row[5], 'metric': row[6]}
+
+
+class SQLiteWorkQueue(SQLWorkQueue):
+    """A single-file work queue for local testing.
+
+    Several processes on one machine (or on machines sharing a filesystem
+    with working locks) can use the same file.
+
+    """
+
+    def __init__(self, path, **kwargs):
+        """Initialization for the SQLiteWorkQueue.
+
+        Args:
+            path (str): Path to the SQLite database file.
+
+        """
+        # The heartbeat thread uses its own queue, but opens it in the worker
+        # thread; each connection is still only used by one thread at a time.
+        connection = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        super().__init__(connection, **kwargs)
+
+    def claim(self, worker_id):
+        now = time.time()
+        cursor = self.connection.cursor()
+        # An immediate transaction takes the write lock, so no two workers
+        # can select the same unit.
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(self.expire(), (now - self.lease_seconds,
+                                           self.max_attempts))
+            cursor.execute(
+                "SELECT " + self.columns + " FROM " +
+                self.table + " WHERE " + self.claimable() + self.claim_order,
+                (now - self.lease_seconds, self.max_attempts, now))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute(
+                    "UPDATE " + self.table + " SET status = 'running', "
+                    "worker = ?, attempts = attempts + 1, claimed_at = ? "
+                    "WHERE unit_id = ?", (worker_id, now, row[0]))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return None if row is None else self.unit_from_row(row)
+
+
+class PostgresWorkQueue(SQLWorkQueue):
+    """A work queue shared between nodes through the PostgreSQL server.
+
+    Claims use SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can
+    pull from the queue concurrently.
+
+    """
+
+    placeholder = "%s"
+
+    def __init__(self, config_yaml, **kwargs):
+        """Initialization for the PostgresWorkQueue.
+
+        Args:
+            config_yaml (str): Path to the database configuration yaml.
+
+        """
+        connection = CMSDBReader(config_yaml).connection
+        super().__init__(connection, **kwargs)
+
+    def claim(self, worker_id):
+        now = time.time()
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql(self.expire()),
+                       (now - self.lease_seconds, self.max_attempts))
+        cursor.execute(self.sql(
+            "UPDATE " + self.table + " SET status = 'running', worker = ?, "
+            "attempts = attempts + 1, claimed_at = ? WHERE unit_id = "
+            "(SELECT unit_id FROM " + self.table + " WHERE " +
+            self.claimable() + self.claim_order + " FOR UPDATE SKIP LOCKED) "
+            "RETURNING " + self.columns),
+            (worker_id, now, now - self.lease_seconds, self.max_attempts,
+             now))
+        row = cursor.fetchone()
+        self.connection.commit()
+        return None if row is None else self.unit_from_row(row)
+
+
+def open_queue(queue_url, config_yaml, create_table=True):
+    """Opens the queue named by a URL.
+
+    Args:
+        queue_url (str): "postgres" to use the configured database, otherwise
+            a path (optionally prefixed with "sqlite://") to a SQLite file.
+        config_yaml (str): Path to the database configuration yaml.
+        create_table (Boolean): Create the queue table if it is missing?
+
+    Returns:
+        A WorkQueue.
+
+    """
+    if queue_url == 'postgres':
+        return PostgresWorkQueue(config_yaml, create_table=create_table)
+    if queue_url.startswith('sqlite://'):
+        queue_url = queue_url[len('sqlite://'):]
+    return SQLiteWorkQueue(queue_url, create_table=create_table)
+
+
+def keep_lease(queue, unit_id, worker_id, stop, lost):
+    """Renews a unit's lease until told to stop (run in a thread).
+
+    Args:
+        queue (WorkQueue): A queue connection used only by the heartbeat.
+        unit_id (str): The unit being worked on.
+        worker_id (str): The worker holding the unit.
+        stop (Event): Set by the worker once the unit is finished.
+        lost (Event): Set here if the claim was taken over by another worker.
+
+    Returns:
+        None
+
+    """
+    while not stop.wait(queue.lease_seconds / 3.0):
+        if not queue.renew(unit_id, worker_id):
+            lost.set()
+            return
+
+
+def run_worker(queue_url, config_yaml, worker_id=None, max_units=None,
+               cache_dir=None, stratum_jobs=1):
+    """Claims and scores units until the queue is drained.
+
+    This is a module-level function so that it can be handed to a process
+    pool; every worker opens its own queue and database connections.
+
+    Args:
+        queue_url (str): The queue to pull from (see open_queue).
+        config_yaml (str): Path to the database configuration yaml.
+        worker_id (str): Name recorded against claimed units.
+        max_units (int): Stop after this many units (None means no limit).
+        cache_dir (str): Local PartitionStore directory for per-year units.
+        stratum_jobs (int): Processes per unit for stratified detectors.
+
+    Returns:
+        Number of units completed by this worker (int).
+
+    """
+    if worker_id is None:
+        worker_id = socket.gethostname() + ":" + str(os.getpid())
+    queue = open_queue(queue_url, config_yaml)
+    # Database connections are not shared between threads, so the heartbeat
+    # renews leases through a second connection to the same queue.
+    lease_queue = open_queue(queue_url, config_yaml, create_table=False)
+    writer = OutlierCountDBWriter(config_yaml)
+    store = PartitionStore(config_yaml, cache_dir) if cache_dir else None
+
+    # Consecutive units usually share a slice, so keep the last one read.
+    slice_key, d_f = None, None
+    completed = 0
+    while max_units is None or completed < max_units:
+        unit = queue.claim(worker_id)
+        if unit is None:
+            break
+        stop, lost = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(
+            target=keep_lease, args=(lease_queue, unit['unit_id'], worker_id,
+                                     stop, lost))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            if unit['fingerprint'] is not None and writer.slice_fingerprint(
+                    [unit['state']], [unit['specialty']],
+                    year=unit['year']) != unit['fingerprint']:
+                print("Partition of " + unit['unit_id'] + " changed since "
+                      "it was queued; cancelling it.")
+                queue.cancel(unit['unit_id'], worker_id, "partition changed")
+                continue
+            key = (unit['year'], unit['state'], unit['specialty'],
+                   unit['fingerprint'])
+            if slice_key != key:
+                if store is not None and unit['year'] is not None:
+                    d_f = store.load(*key)
+                else:
+                    d_f = PandasDBReader(config_yaml, [unit['state']],
+                                         [unit['specialty']],
+                                         optimize_dtypes=True,
+                                         year=unit['year']).d_f
+                slice_key = key
+            # An empty slice is still written, which clears any rows left
+            # behind by an earlier refresh.
+            counts = pd.DataFrame()
+            if not d_f.empty:
+                counts = run_detector(d_f.copy(), unit['config'],
+                                      regression_vars, response_var,
+                                      n_jobs=stratum_jobs)
+            # Each release year gets its own outlier count table.
+            metric = unit['metric']
+            if unit['year'] is not None:
+                metric += "_" + str(unit['year'])
+            if not lost.is_set():
+                writer.write_slice(metric, unit['state'], unit['specialty'],
+                                   counts)
+        except Exception as err:
+            # Never reuse a slice that may not belong to this unit.
+            slice_key, d_f = None, None
+            print("Unit " + unit['unit_id'] + " failed: " + repr(err))
+            queue.fail(unit['unit_id'], worker_id, repr(err))
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+        if lost.is_set():
+            print("Lost the lease on " + unit['unit_id'] + "; skipping it.")
+            continue
+        queue.complete(unit['unit_id'], worker_id)
+        completed += 1
+    return completed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sharded batch scoring of outlier counts.")
+    parser.add_argument('command', choices=['enqueue', 'work', 'status',
+                                            'retry', 'reset'],
+                        help="'retry' requeues failed units, 'reset' requeues "
+                             "failed and done units for another refresh.")
+    parser.add_argument('--queue', default="./scoring_queue.db",
+                        help="'postgres' or a path to a SQLite queue file.")
+    parser.add_argument('--config', default="./config.yaml")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Worker processes to run on this node.")
+    parser.add_argument('--years', type=int, nargs='*', default=None,
+                        help="CMS release years to score (see year_tables).")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Local cache for per-year partitions.")
+    parser.add_argument('--stratum-jobs', type=int, default=1,
+                        help="Processes per unit for stratified detectors.")
+    args = parser.parse_args()
+
+    if args.command == 'enqueue':
+        states = [opt['state'] for opt in regional_options]
+        specialties = [opt['type'] for opt in specialty_options]
+        open_queue(args.queue, args.config).put(
+            make_units(states, specialties, served_metrics(args.config),
+                       years=args.years, config_yaml=args.config))
+    elif args.command == 'work':
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [executor.submit(run_worker, args.queue, args.config,
+                                       cache_dir=args.cache_dir,
+                                       stratum_jobs=args.stratum_jobs)
+                       for _ in range(args.processes)]
+            print("Completed " + str(sum(f.result() for f in futures)) +
+                  " units.")
+    elif args.command in ('retry', 'reset'):
+        statuses = ('failed',) if args.command == 'retry' else \
+            ('done', 'failed')
+        print("Requeued " + str(open_queue(args.queue, args.config).reset(
+            statuses)) + " units.")
+    print(open_queue(args.queue, args.config).status_counts())
+
+
+if __name__ == "__main__":
+    main()
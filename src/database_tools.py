@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import yaml
 import psycopg2
-import pandas as pd
 
 __author__ = "Daniel Hannah"
 __email__ = "dan@danhannah.site"
@@ -13,9 +13,95 @@ The PandasDBReader class builds a dataframe from the database with a requested
 set of features as the columns. Eventually I may include a PandasCSVReader which
 populates the same fields so that the Flask app can take CSV input.
 
+Pandas is imported inside the readers rather than at module load so that
+importing this module (e.g. when a Flask worker boots) stays cheap.
+
+Claims slices can be converted at load time to the compact dtypes listed under
+"dtypes" in the configuration yaml (categoricals, an integer NPI, float32
+features and interned strings), which matters for the larger slices. The plan
+is opt-in (optimize_dtypes=True) because it changes the NPI column from strings
+to integers: callers that turn it on must compare NPIs as strings, e.g. against
+fh_config.fraudulent_npis, by converting them with str() first.
+
 """
 
 
+def apply_dtype_plan(d_f, dtype_plan):
+    """Converts the columns of a dataframe in place to a compact dtype plan.
+
+    Besides the usual Pandas dtypes, the plan accepts "intern" for string
+    columns which repeat heavily but are not worth a categorical; the values
+    are interned so that every repeat shares a single Python string.
+
+    Args:
+        d_f (DataFrame): A Pandas DataFrame read from the database.
+        dtype_plan (dict): A mapping of column names to dtypes.
+
+    Returns:
+        The same DataFrame, for convenience.
+
+    """
+    import pandas as pd
+    for col, dtype in dtype_plan.items():
+        if col not in d_f.columns:
+            continue
+        if dtype == 'intern':
+            interned = [sys.intern(val) if isinstance(val, str) else val
+                        for val in d_f[col].values]
+            d_f[col] = pd.Series(interned, index=d_f.index, dtype=object)
+        elif dtype.startswith(('int', 'uint')):
+            d_f[col] = pd.to_numeric(d_f[col]).astype(dtype)
+        else:
+            d_f[col] = d_f[col].astype(dtype)
+    return d_f
+
+
+def column_memory(column):
+    """Estimates the memory held by a column, counting shared objects once.
+
+    Pandas' deep memory usage counts every reference to an object separately,
+    which hides the savings from interning, so object columns are measured by
+    the distinct objects they point to.
+
+    Args:
+        column (Series): A Pandas Series.
+
+    Returns:
+        Memory usage in bytes (int).
+
+    """
+    if column.dtype != object:
+        return int(column.memory_usage(index=False, deep=True))
+    distinct = {id(val): val for val in column.values}
+    return int(column.memory_usage(index=False, deep=False)) + \
+        sum(sys.getsizeof(val) for val in distinct.values())
+
+
+def memory_report(before, after):
+    """Compares the per-column memory usage of two versions of a dataframe.
+
+    Args:
+        before (DataFrame): The DataFrame as originally read.
+        after (DataFrame): The DataFrame after the dtype plan was applied.
+
+    Returns:
+        A Pandas DataFrame of bytes before/after and the saving per column,
+        with a "total" row.
+
+    """
+    import pandas as pd
+    report = pd.DataFrame(
+        {'dtype': [str(after[col].dtype) for col in after.columns],
+         'bytes_before': [column_memory(before[col]) for col in after.columns],
+         'bytes_after': [column_memory(after[col]) for col in after.columns]},
+        index=list(after.columns))
+    report.loc['total'] = ['', report['bytes_before'].sum(),
+                           report['bytes_after'].sum()]
+    report['saved_pct'] = 100.0 * (1 - report['bytes_after'] /
+                                   report['bytes_before'].clip(lower=1))
+    return report
+
+
 class CMSDBReader:
     """General superclass for database readers.
 
@@ -43,6 +129,52 @@ class CMSDBReader:
             password=self.configuration['password']
         )
 
+    def year_table(self, year=None):
+        """Gets the name of the table holding one CMS release year.
+
+        Args:
+            year (int): The release year, or None for the original table.
+
+        Returns:
+            A table name (str).
+
+        """
+        if year is None:
+            return 'cms'
+        year_tables = self.configuration.get('year_tables') or {}
+        if year not in year_tables:
+            raise ValueError("No table configured for CMS year " + str(year))
+        return year_tables[year]
+
+    def slice_fingerprint(self, region_list, specialty_list, year=None):
+        """Summarizes a slice so that changes to it can be detected.
+
+        The fingerprint is the row count plus an MD5 hash of every configured
+        feature of every row, taken in a fixed order, so a reload that changes
+        any value of the slice is noticed. Hashing the text form of the rows
+        also avoids the last-digit wobble of floating point sums.
+
+        Args:
+            region_list (list): A list of US states.
+            specialty_list (list): A list of specialties.
+            year (int): The release year, or None for the original table.
+
+        Returns:
+            A string of the form "<row count>:<md5 hex digest>".
+
+        """
+        query_dict = {"provider_type": specialty_list,
+                      "nppes_provider_state": region_list}
+        row_text = "CAST(ROW(" + ", ".join(self.configuration['features']) + \
+                   ") AS TEXT)"
+        query = self.build_query(
+            ["COUNT(*)", "md5(string_agg(" + row_text + ", '|' ORDER BY " +
+             row_text + "))"], query_dict, table=self.year_table(year))
+        with self.connection.cursor() as cursor:
+            cursor.execute(query)
+            row = cursor.fetchone()
+        return ":".join(str(val) for val in row)
+
     @staticmethod
     def build_query(need_cols, q_dict, table='cms'):
         """Queries the SQL database for a subset of the data.
@@ -81,16 +213,23 @@ class PandasDBReader(CMSDBReader):
     Attributes:
         connection (psycopg2): A SQL database connection.
         d_f (DataFrame): A Pandas data frame.
+        memory_report (DataFrame): Memory saved by the dtype plan, per column
+            (None if the plan was not applied).
 
     """
 
-    def __init__(self, config_yaml, region_list, specialty_list):
+    def __init__(self, config_yaml, region_list, specialty_list,
+                 optimize_dtypes=False, report_memory=False, year=None):
         """Initialization for the PandasDBReader.
 
         Args:
             config_yaml (YAML): A YAML file containing configuration info.
             region_list (list): A list of US states to get info from.
             specialty_list (list): A list of specialties to get info on.
+            optimize_dtypes (Boolean): Apply the configured dtype plan? Note
+                that the plan makes the NPI column an integer.
+            report_memory (Boolean): Measure the memory saved by the plan?
+            year (int): CMS release year to read (None for the 'cms' table).
 
         """
         super().__init__(config_yaml)
@@ -98,11 +237,22 @@ class PandasDBReader(CMSDBReader):
         # Build a query from the provided region/specialty lists.
         query_dict = {"provider_type": specialty_list,
                       "nppes_provider_state": region_list}
-        query = self.build_query(self.configuration['features'], query_dict)
+        query = self.build_query(self.configuration['features'], query_dict,
+                                 table=self.year_table(year))
 
         # Use the query to create a dataframe from the database.
+        import pandas as pd
         self.d_f = pd.read_sql_query(query, self.connection)
 
+        # Shrink the frame to the configured compact dtypes.
+        self.memory_report = None
+        dtype_plan = self.configuration.get('dtypes') or {}
+        if optimize_dtypes and dtype_plan:
+            original = self.d_f.copy() if report_memory else None
+            apply_dtype_plan(self.d_f, dtype_plan)
+            if report_memory:
+                self.memory_report = memory_report(original, self.d_f)
+
 
 class OutlierCountDBReader(CMSDBReader):
     """A database reader class for the outlier counts table (for speed!)
@@ -134,7 +284,80 @@ class OutlierCountDBReader(CMSDBReader):
         query_dict = {"provider_type": specialty_list,
                       "state": region_list}
         query = self.build_query(outlier_cols, query_dict, table=table_name)
+        # The Flask app shows the head of this frame, so rank it here.
+        query += " ORDER BY outlier_count DESC"
         print("RUNNING QUERY " + query)
 
         # Use the query to create a dataframe from the database.
+        import pandas as pd
         self.d_f = pd.read_sql_query(query, self.connection)
+
+
+class OutlierCountDBWriter(CMSDBReader):
+    """Writes per-provider outlier counts into the outlier count tables.
+
+    Each (state, specialty) slice is replaced in a single transaction that
+    holds an advisory lock on the slice, so re-running a slice (e.g. after a
+    batch job is resumed, or by two workers at once) never duplicates rows.
+
+    Attributes:
+        connection (psycopg2): A SQL database connection.
+
+    """
+
+    outlier_cols = ['npi', 'state', 'lastname', 'provider_type',
+                    'outlier_count', 'cost', 'outlier_rate']
+
+    def create_table(self, metric):
+        """Creates the outlier count table for a metric if it is missing.
+
+        Args:
+            metric (str): Suffix of the table, e.g. "hdb_total".
+
+        Returns:
+            The table name (str).
+
+        """
+        table_name = "provider_anomaly_counts_" + metric
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS " + table_name + " (npi TEXT, "
+                "state TEXT, lastname TEXT, provider_type TEXT, "
+                "outlier_count INTEGER, cost DOUBLE PRECISION, "
+                "outlier_rate DOUBLE PRECISION)")
+        self.connection.commit()
+        return table_name
+
+    def write_slice(self, metric, state, specialty, counts_df):
+        """Replaces the outlier counts of one slice.
+
+        Args:
+            metric (str): Suffix of the table, e.g. "hdb_total".
+            state (str): Two-letter state code.
+            specialty (str): Provider type.
+            counts_df (DataFrame): Output of AnomalyDetector.get_most_frequent;
+                an empty frame just clears the slice.
+
+        Returns:
+            Number of rows written (int).
+
+        """
+        table_name = self.create_table(metric)
+        rows = [(str(npi), state, row['last_name'], specialty,
+                 int(row['outlier_count']), float(row['cost_to_medicare']),
+                 float(row['outlier_count_rate']))
+                for npi, row in counts_df.iterrows()]
+        insert = "INSERT INTO " + table_name + " (" + \
+                 ", ".join(self.outlier_cols) + ") VALUES (" + \
+                 ", ".join(["%s"] * len(self.outlier_cols)) + ")"
+        with self.connection:
+            with self.connection.cursor() as cursor:
+                # Without the lock, a concurrent writer's DELETE would not see
+                # our uncommitted INSERT and both copies would survive.
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                               ("|".join([table_name, state, specialty]),))
+                cursor.execute("DELETE FROM " + table_name +
+                               " WHERE state = %s AND provider_type = %s",
+                               (state, specialty))
+                cursor.executemany(insert, rows)
+        return len(rows)
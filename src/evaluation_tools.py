@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from anomaly_tools import run_detector, config_label
+from database_tools import CMSDBReader, PandasDBReader
+from fh_config import regional_options, specialty_options, regression_vars, \
+    response_var, fraudulent_npis
+
+__author__ = "Daniel Hannah"
+__email__ = "dan@danhannah.site"
+
+"""Tools for measuring how well detector rankings recover known fraud.
+
+The providers in fh_config.fraudulent_npis are used as (incomplete) ground
+truth. For every (state, specialty) slice and every detector configuration we
+rank the providers that have at least one outlier by outlier count and compute
+recall@k, precision@k and average precision. Providers without any outliers
+are left unranked (they would all tie, and their order would say nothing about
+the detector). Slices are scored in parallel and the per-slice rankings are
+cached on disk under a key that includes the version of the data, so re-running
+the evaluation (e.g. with a new candidate engine) only fits the configurations
+that have not been seen before on the current data.
+
+"""
+
+DEFAULT_CONFIGS = [
+    {'detector': 'hdb', 'min_size': 15, 'percent': 2},
+    {'detector': 'kmeans', 'num_clusters': 8, 'percent': 10},
+    {'detector': 'hdb', 'min_size': 15, 'percent': 2, 'stratify': 'family'},
+]
+
+DEFAULT_KS = [10, 20, 50]
+
+
+def precision_at_k(ranked_npis, fraud_npis, k):
+    """Fraction of the top k ranked providers that are known fraud cases.
+
+    Rankings with fewer than k flagged providers are scored over all of them,
+    so that small slices are not capped below 1.
+
+    Args:
+        ranked_npis (list): NPIs ordered from most to least suspicious.
+        fraud_npis (set): NPIs of known fraudulent providers.
+        k (int): Cutoff rank.
+
+    Returns:
+        Precision at k (float).
+
+    """
+    top_k = ranked_npis[:k]
+    if not top_k:
+        return np.nan
+    return sum(npi in fraud_npis for npi in top_k) / float(len(top_k))
+
+
+def recall_at_k(ranked_npis, fraud_npis, k):
+    """Fraction of the known fraud cases found in the top k ranked providers.
+
+    Args:
+        ranked_npis (list): NPIs ordered from most to least suspicious.
+        fraud_npis (set): NPIs of known fraudulent providers in this slice.
+        k (int): Cutoff rank.
+
+    Returns:
+        Recall at k (float), or NaN if the slice has no known fraud cases.
+
+    """
+    if not fraud_npis:
+        return np.nan
+    return sum(npi in fraud_npis for npi in ranked_npis[:k]) / \
+        float(len(fraud_npis))
+
+
+def average_precision(ranked_npis, fraud_npis):
+    """Average of precision@k taken at the rank of each known fraud case.
+
+    Fraud cases missing from the ranking (i.e. never flagged) count as zero.
+
+    Args:
+        ranked_npis (list): NPIs ordered from most to least suspicious.
+        fraud_npis (set): NPIs of known fraudulent providers in this slice.
+
+    Returns:
+        Average precision (float), or NaN if the slice has no fraud cases.
+
+    """
+    if not fraud_npis:
+        return np.nan
+    hits = 0
+    precision_sum = 0.0
+    for rank, npi in enumerate(ranked_npis, start=1):
+        if npi in fraud_npis:
+            hits += 1
+            precision_sum += hits / float(rank)
+    return precision_sum / len(fraud_npis)
+
+
+def score_ranking(ranked_npis, fraud_npis, k_list=DEFAULT_KS):
+    """Computes all of the ranking metrics for a single ranking.
+
+    Args:
+        ranked_npis (list): NPIs ordered from most to least suspicious.
+        fraud_npis (set): NPIs of known fraudulent providers in this slice.
+        k_list (list): Cutoff ranks for precision and recall.
+
+    Returns:
+        A dictionary mapping metric names to values.
+
+    """
+    metrics = {'n_flagged': len(ranked_npis),
+               'n_fraud': len(fraud_npis),
+               'average_precision': average_precision(ranked_npis, fraud_npis)}
+    for k in k_list:
+        metrics['precision@' + str(k)] = precision_at_k(ranked_npis,
+                                                        fraud_npis, k)
+        metrics['recall@' + str(k)] = recall_at_k(ranked_npis, fraud_npis, k)
+    return metrics
+
+
+def data_version(config_yaml, state, specialty):
+    """Identifies the data that the rankings of a slice are computed from.
+
+    The slice fingerprint changes whenever the table is reloaded, and the
+    configured features and dtype plan change how the slice is loaded, so all
+    three go into the key.
+
+    Args:
+        config_yaml (str): Path to the database configuration yaml.
+        state (str): Two-letter state code.
+        specialty (str): Provider type.
+
+    Returns:
+        A short hash (str).
+
+    """
+    reader = CMSDBReader(config_yaml)
+    version = [reader.year_table(),
+               reader.slice_fingerprint([state], [specialty]),
+               reader.configuration.get('features'),
+               reader.configuration.get('dtypes')]
+    reader.connection.close()
+    return hashlib.md5(json.dumps(version, sort_keys=True).encode(
+        'utf-8')).hexdigest()[:12]
+
+
+def cache_path(cache_dir, state, specialty, det_config, version):
+    """Location of the cached ranking for one slice and configuration.
+
+    Args:
+        cache_dir (str): Directory holding cached rankings.
+        state (str): Two-letter state code.
+        specialty (str): Provider type.
+        det_config (dict): A detector configuration.
+        version (str): Version of the slice's data (see data_version).
+
+    Returns:
+        A file path (str).
+
+    """
+    fname = "_".join([state, specialty.replace(" ", "-"),
+                      config_label(det_config), version]) + ".pkl"
+    return os.path.join(cache_dir, fname)
+
+
+def flagged_npis(ranked):
+    """NPIs of the providers with at least one outlier, most suspicious first.
+
+    Args:
+        ranked (DataFrame): Output of run_detector, indexed by NPI.
+
+    Returns:
+        A list of NPIs (str).
+
+    """
+    return [str(npi) for npi in ranked.index[ranked['outlier_count'] > 0]]
+
+
+def rank_slice(config_yaml, state, specialty, det_configs, cache_dir=None,
+               stratum_jobs=1):
+    """Ranks the providers of one slice under each detector configuration.
+
+    The slice is only read from the database if at least one configuration
+    is missing from the cache. This is a module-level function so that it can
+    be handed to a process pool.
+
+    Args:
+        config_yaml (str): Path to the database configuration yaml.
+        state (str): Two-letter state code.
+        specialty (str): Provider type.
+        det_configs (list): Detector configurations to rank with.
+        cache_dir (str): Directory for cached rankings (None disables it).
+        stratum_jobs (int): Worker processes for stratified fits.
+
+    Returns:
+        A list of every provider NPI in the slice, and a dictionary mapping
+        configuration labels to lists of the flagged NPIs in ranked order.
+
+    """
+    providers = None
+    rankings = {}
+    d_f = None
+    version = None
+    if cache_dir is not None:
+        version = data_version(config_yaml, state, specialty)
+    for det_config in det_configs:
+        label = config_label(det_config)
+        path = None
+        if cache_dir is not None:
+            path = cache_path(cache_dir, state, specialty, det_config, version)
+            if os.path.exists(path):
+                ranked = pd.read_pickle(path)
+                providers = [str(npi) for npi in ranked.index]
+                rankings[label] = flagged_npis(ranked)
+                continue
+        if d_f is None:
+            d_f = PandasDBReader(config_yaml, [state], [specialty],
+                                 optimize_dtypes=True).d_f
+            providers = sorted(set(str(npi) for npi in d_f['npi']))
+        if d_f.empty:
+            rankings[label] = []
+            continue
+        # The detectors add columns to the frame they are given.
+        ranked = run_detector(d_f.copy(), det_config, regression_vars,
+                              response_var, n_jobs=stratum_jobs)
+        ranked.index = ranked.index.astype(str)
+        if path is not None:
+            ranked.to_pickle(path)
+        rankings[label] = flagged_npis(ranked)
+    return providers or [], rankings
+
+
+class RankingEvaluator:
+    """Evaluates detector rankings against the known fraudulent providers.
+
+    Attributes:
+        config_yaml (str): Path to the database configuration yaml.
+        det_configs (list): Detector configurations to compare.
+        k_list (list): Cutoff ranks for precision and recall.
+        cache_dir (str): Directory for cached per-slice rankings.
+        fraud_npis (set): NPIs of known fraudulent providers (as strings).
+        report (DataFrame): Per-slice metrics, populated by evaluate().
+
+    """
+
+    def __init__(self, config_yaml, det_configs=DEFAULT_CONFIGS,
+                 k_list=DEFAULT_KS, cache_dir=None):
+        """Initialization for the RankingEvaluator.
+
+        Args:
+            config_yaml (str): Path to the database configuration yaml.
+            det_configs (list): Detector configurations to compare.
+            k_list (list): Cutoff ranks for precision and recall.
+            cache_dir (str): Directory for cached rankings (None disables it).
+
+        """
+        self.config_yaml = config_yaml
+        self.det_configs = det_configs
+        self.k_list = k_list
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.fraud_npis = set(str(npi) for npi in fraudulent_npis)
+        self.report = None
+
+    def evaluate(self, states=None, specialties=None, n_jobs=None,
+                 stratum_jobs=1):
+        """Ranks and scores every (state, specialty) slice in parallel.
+
+        Args:
+            states (list): States to evaluate, defaults to all of them.
+            specialties (list): Specialties to evaluate, defaults to all.
+            n_jobs (int): Number of worker processes (None uses all cores).
+            stratum_jobs (int): Processes per slice for stratified fits.
+
+        Returns:
+            A Pandas DataFrame with one row per slice and configuration.
+
+        """
+        if states is None:
+            states = [opt['state'] for opt in regional_options]
+        if specialties is None:
+            specialties = [opt['type'] for opt in specialty_options]
+        slices = [(state, spec) for state in states for spec in specialties]
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(rank_slice, self.config_yaml, state,
+                                       spec, self.det_configs, self.cache_dir,
+                                       stratum_jobs)
+                       for state, spec in slices]
+            for (state, spec), future in zip(slices, futures):
+                providers, rankings = future.result()
+                # Recall is relative to the fraud cases in this slice, flagged
+                # or not.
+                slice_fraud = self.fraud_npis.intersection(providers)
+                for label, ranked_npis in rankings.items():
+                    row = {'state': state, 'specialty': spec,
+                           'config': label, 'n_providers': len(providers)}
+                    row.update(score_ranking(ranked_npis, slice_fraud,
+                                             self.k_list))
+                    rows.append(row)
+        self.report = pd.DataFrame(rows)
+        return self.report
+
+    def summarize(self):
+        """Averages the per-slice metrics for each detector configuration.
+
+        Only slices that contain at least one known fraud case contribute, as
+        the metrics are undefined elsewhere.
+
+        Returns:
+            A Pandas DataFrame indexed by configuration label.
+
+        """
+        if self.report is None:
+            print("Rankings must be evaluated prior to summarizing.")
+            return
+        scored = self.report[self.report['n_fraud'] > 0]
+        metric_cols = [col for col in scored.columns if
+                       col not in ('state', 'specialty', 'config')]
+        summary = scored.groupby('config')[metric_cols].mean()
+        summary['n_slices'] = scored.groupby('config').size()
+        return summary.sort_values(by='average_precision', ascending=False)
+
+    def accept_candidate(self, baseline, candidate, tolerance=0.05):
+        """Checks whether a candidate engine's ranking quality holds up.
+
+        Args:
+            baseline (dict): The reference detector configuration.
+            candidate (dict): The faster or approximate configuration.
+            tolerance (float): Allowed drop in any summarized metric.
+
+        Returns:
+            True if no metric drops by more than the tolerance.
+
+        """
+        summary = self.summarize()
+        base = summary.loc[config_label(baseline)]
+        cand = summary.loc[config_label(candidate)]
+        metric_cols = [col for col in summary.columns if
+                       col.startswith(('precision@', 'recall@', 'average_'))]
+        return bool(((base[metric_cols] - cand[metric_cols]) <=
+                     tolerance).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate detector rankings against known fraud NPIs.")
+    parser.add_argument('--config', default="./config.yaml")
+    parser.add_argument('--cache-dir', default="./eval_cache")
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--stratum-jobs', type=int, default=1,
+                        help="Processes per slice for stratified detectors.")
+    parser.add_argument('--output', default="./ranking_evaluation.csv")
+    args = parser.parse_args()
+
+    evaluator = RankingEvaluator(args.config, cache_dir=args.cache_dir)
+    report = evaluator.evaluate(n_jobs=args.n_jobs,
+                                stratum_jobs=args.stratum_jobs)
+    report.to_csv(args.output, index=False)
+    print(evaluator.summarize().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+import tempfile
+import pandas as pd
+from database_tools import CMSDBReader, PandasDBReader
+from fh_config import regional_options, specialty_options
+
+__author__ = "Daniel Hannah"
+__email__ = "dan@danhannah.site"
+
+"""Per-year partitions of the CMS data and incremental cross-year features.
+
+Each CMS release year lives in its own table (see year_tables in config.yaml),
+and every (year, state, specialty) slice of it is treated as a partition. The
+PartitionStore caches partitions on disk under a fingerprint of the database
+rows, so a partition is only re-read when a new year is added or an existing
+year is reloaded. Alongside each partition a small per-provider summary is
+stored; year-over-year trend features are computed from the summaries of two
+adjacent years rather than by rescanning all of the history. Running this
+script writes the trend features of every slice of a year to a CSV file.
+
+"""
+
+
+def summarize_providers(d_f):
+    """Aggregates a claims partition to one row per provider.
+
+    Args:
+        d_f (DataFrame): A Pandas DataFrame of claims for one partition.
+
+    Returns:
+        A Pandas DataFrame indexed by NPI with the service count, the number
+        of distinct procedures and the total Medicare payment.
+
+    """
+    payments = d_f['line_srvc_cnt'].astype(float) * \
+        d_f['average_medicare_payment_amt'].astype(float)
+    grouped = d_f.assign(payment=payments).groupby('npi')
+    summary = pd.DataFrame({
+        'srvc_cnt': grouped['line_srvc_cnt'].sum().astype(float),
+        'num_proc': grouped.size(),
+        'payment': grouped['payment'].sum()
+    })
+    summary.index = summary.index.astype(str)
+    return summary
+
+
+class PartitionStore:
+    """On-disk cache of per-year claims partitions and provider summaries.
+
+    Cached files are named after the fingerprint of the data they hold, so a
+    file can only ever be found for the version of the partition it was read
+    from. Each file is written to a temporary file and then moved into place,
+    so several worker processes can share one cache directory without seeing
+    half-written files. Older versions of a partition are removed once a newer
+    one has been written.
+
+    Attributes:
+        config_yaml (str): Path to the database configuration yaml.
+        cache_dir (str): Directory holding the cached partitions.
+        reader (CMSDBReader): Connection used for fingerprint queries.
+
+    """
+
+    def __init__(self, config_yaml, cache_dir):
+        """Initialization for the PartitionStore.
+
+        Args:
+            config_yaml (str): Path to the database configuration yaml.
+            cache_dir (str): Directory holding the cached partitions.
+
+        """
+        self.config_yaml = config_yaml
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.reader = CMSDBReader(config_yaml)
+
+    def partition_path(self, year, state, specialty, kind, fingerprint):
+        """Location of one version of a partition's "claims" or "summary"."""
+        fname = "_".join([str(year), state, specialty.replace(" ", "-"),
+                          fingerprint.replace(":", "-"), kind]) + ".pkl"
+        return os.path.join(self.cache_dir, fname)
+
+    def replace_file(self, path, write):
+        """Writes a file atomically via a temporary file in the same folder.
+
+        Args:
+            path (str): Final location of the file.
+            write (function): Called with the temporary path to fill it.
+
+        Returns:
+            None
+
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def remove_old_versions(self, year, state, specialty, fingerprint):
+        """Deletes the cached files of other versions of a partition."""
+        keep = [self.partition_path(year, state, specialty, kind, fingerprint)
+                for kind in ('claims', 'summary')]
+        prefix = "_".join([str(year), state, specialty.replace(" ", "-"), ""])
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            if fname.startswith(prefix) and fname.endswith(
+                    ("_claims.pkl", "_summary.pkl")) and path not in keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def fingerprint(self, year, state, specialty):
+        """Fingerprints a partition as it currently is in the database."""
+        return self.reader.slice_fingerprint([state], [specialty], year=year)
+
+    def load(self, year, state, specialty, fingerprint=None):
+        """Gets a partition, reading it from the database only if it changed.
+
+        When the partition has to be read, it is fingerprinted again
+        afterwards; if it no longer matches (the year was reloaded in the
+        meantime, or the given fingerprint was already out of date) nothing
+        is cached and a ValueError is raised.
+
+        Args:
+            year (int): CMS release year.
+            state (str): Two-letter state code.
+            specialty (str): Provider type.
+            fingerprint (str): The version of the partition wanted; defaults
+                to the current one.
+
+        Returns:
+            A Pandas DataFrame of the partition's claims.
+
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint(year, state, specialty)
+        path = self.partition_path(year, state, specialty, 'claims',
+                                   fingerprint)
+        try:
+            return pd.read_pickle(path)
+        except FileNotFoundError:
+            pass
+
+        d_f = PandasDBReader(self.config_yaml, [state], [specialty],
+                             optimize_dtypes=True, year=year).d_f
+        if self.fingerprint(year, state, specialty) != fingerprint:
+            raise ValueError("Partition " + "|".join([str(year), state,
+                                                      specialty]) +
+                             " does not match fingerprint " + fingerprint)
+        self.replace_file(
+            self.partition_path(year, state, specialty, 'summary',
+                                fingerprint),
+            summarize_providers(d_f).to_pickle)
+        self.replace_file(path, d_f.to_pickle)
+        self.remove_old_versions(year, state, specialty, fingerprint)
+        return d_f
+
+    def summary(self, year, state, specialty):
+        """Gets the per-provider summary of the current partition.
+
+        Args:
+            year (int): CMS release year.
+            state (str): Two-letter state code.
+            specialty (str): Provider type.
+
+        Returns:
+            A Pandas DataFrame indexed by NPI.
+
+        """
+        fingerprint = self.fingerprint(year, state, specialty)
+        try:
+            return pd.read_pickle(self.partition_path(
+                year, state, specialty, 'summary', fingerprint))
+        except FileNotFoundError:
+            return summarize_providers(self.load(year, state, specialty,
+                                                 fingerprint))
+
+    def trend_features(self, year, state, specialty):
+        """Computes each provider's change since the previous release year.
+
+        Only the summaries of this year and the one before are read (after
+        checking that they are still current), so the cost does not grow with
+        the number of years in the database.
+
+        Args:
+            year (int): CMS release year.
+            state (str): Two-letter state code.
+            specialty (str): Provider type.
+
+        Returns:
+            A Pandas DataFrame indexed by NPI; providers missing from the
+            previous year have NaN changes.
+
+        """
+        current = self.summary(year, state, specialty)
+        year_tables = self.reader.configuration.get('year_tables') or {}
+        if year - 1 in year_tables:
+            previous = self.summary(year - 1, state, specialty)
+        else:
+            previous = pd.DataFrame(columns=current.columns, dtype=float)
+        trend = current.join(previous, rsuffix='_prev', how='left')
+        for col in ['srvc_cnt', 'num_proc', 'payment']:
+            trend[col + '_yoy_change'] = trend[col] - trend[col + '_prev']
+            trend[col + '_yoy_pct'] = 100.0 * trend[col + '_yoy_change'] / \
+                trend[col + '_prev'].where(trend[col + '_prev'] > 0)
+        return trend
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write per-provider year-over-year trend features.")
+    parser.add_argument('year', type=int)
+    parser.add_argument('--config', default="./config.yaml")
+    parser.add_argument('--cache-dir', default="./partition_cache")
+    parser.add_argument('--states', nargs='*', default=None)
+    parser.add_argument('--specialties', nargs='*', default=None)
+    parser.add_argument('--output', default=None,
+                        help="CSV file, defaults to ./trends_<year>.csv.")
+    args = parser.parse_args()
+
+    states = args.states or [opt['state'] for opt in regional_options]
+    specialties = args.specialties or \
+        [opt['type'] for opt in specialty_options]
+    store = PartitionStore(args.config, args.cache_dir)
+    frames = []
+    for state in states:
+        for specialty in specialties:
+            trend = store.trend_features(args.year, state, specialty)
+            frames.append(trend.assign(state=state, provider_type=specialty))
+    output = args.output or "./trends_" + str(args.year) + ".csv"
+    pd.concat(frames).to_csv(output, index_label='npi')
+    print("Wrote trend features for " + str(len(frames)) + " slices to " +
+          output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from bokeh.models import ColumnDataSource, DataRange1d, SingleIntervalTicker,\
-    LinearAxis, LabelSet
-from bokeh.plotting import figure
-from bokeh.models.glyphs import HBar
-from bokeh.embed import components
 from fh_config import fraudulent_npis
 
 __author__ = "Daniel Hannah"
@@ -14,7 +9,8 @@ __email__ = "dan@danhannah.site"
 
 This set of tools has been deprecated and is no longer in use on FraudHacker (I
 switched to chartJS for a variety of reasons), but is here just in case it
-becomes useful in the future.
+becomes useful in the future. The Bokeh imports are deferred to the plotting
+functions so that the Flask app can use get_bar_colors without loading Bokeh.
 
 """
 
@@ -29,6 +25,12 @@ def render_bar_plot(source, plt_title):
     Returns:
         Components of a bar plot figure.
     """
+    from bokeh.models import DataRange1d, SingleIntervalTicker, LinearAxis, \
+        LabelSet
+    from bokeh.plotting import figure
+    from bokeh.models.glyphs import HBar
+    from bokeh.embed import components
+
     bar_height = 0.5
     top_stop = len(source.data["tick_labels"]) - 1 + bar_height
     bottom_start = -1 * bar_height
@@ -83,6 +85,8 @@ def create_source(w_n_df, bar_value):
         A ColumnDataSource object.
 
     """
+    from bokeh.models import ColumnDataSource
+
     # Get the info we need from the DataFrame.
     indices = [i for i in range(w_n_df.shape[0])]
     npis = w_n_df['npi'].values
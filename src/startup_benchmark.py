@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import subprocess
+
+__author__ = "Daniel Hannah"
+__email__ = "dan@danhannah.site"
+
+"""Cold-start benchmark for the Flask app and the command line tools.
+
+Each module is imported in a fresh interpreter running with -X importtime,
+which is what a newly forked gunicorn worker has to do before it can serve a
+request.
+The report gives the total import time, the peak resident memory of that
+interpreter and the slowest direct dependencies of each module. With --max-ms
+the script exits with a non-zero status when a module takes longer than the
+budget, so it can be used as a CI gate.
+
+"""
+
+DEFAULT_MODULES = ['flask_app_java', 'database_tools', 'anomaly_tools',
+                   'plotting_tools']
+
+# Run inside the child interpreter: import the target, then report peak RSS.
+CHILD_CODE = """
+import resource, sys
+__import__(sys.argv[1])
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def parse_importtime(stderr_text):
+    """Parses the output of python -X importtime.
+
+    Args:
+        stderr_text (str): The stderr of an interpreter run with importtime.
+
+    Returns:
+        A list of (module, self_us, cumulative_us, depth) tuples.
+
+    """
+    records = []
+    for line in stderr_text.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Top-level imports are preceded by one space, nested ones by two more.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        records.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return records
+
+
+def measure_module(module, python=sys.executable):
+    """Imports a module in a cold interpreter and measures the cost.
+
+    Args:
+        module (str): Name of the module to import.
+        python (str): Interpreter to use, defaults to the current one.
+
+    Returns:
+        A dictionary with total import time (ms), peak RSS (MB) and the
+        import records of the module's direct dependencies.
+
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([python, "-X", "importtime", "-c", CHILD_CODE,
+                             module], cwd=here, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing " + module + " failed:\n" +
+                           result.stderr[-2000:])
+    records = parse_importtime(result.stderr)
+
+    # The target is the last top-level record; its direct dependencies are
+    # the depth-one records logged since the previous top-level import.
+    target_idx = max(idx for idx, rec in enumerate(records)
+                     if rec[3] == 0 and rec[0] == module)
+    start_idx = target_idx
+    while start_idx > 0 and records[start_idx - 1][3] > 0:
+        start_idx -= 1
+    children = [rec for rec in records[start_idx:target_idx] if rec[3] == 1]
+    max_rss_kb = int(result.stdout.strip().splitlines()[-1])
+    if sys.platform == 'darwin':
+        max_rss_kb //= 1024  # ru_maxrss is reported in bytes on macOS.
+    return {'module': module,
+            'import_ms': records[target_idx][2] / 1000.0,
+            'max_rss_mb': max_rss_kb / 1024.0,
+            'dependencies': children}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report cold-start import time and memory per module.")
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of slowest imports to list per module.")
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="Fail if any module takes longer than this.")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        stats = measure_module(module)
+        print("%s: %.1f ms, %.1f MB peak RSS" % (module, stats['import_ms'],
+                                                 stats['max_rss_mb']))
+        slowest = sorted(stats['dependencies'], key=lambda rec: rec[2],
+                         reverse=True)[:args.top]
+        for name, _, cumulative_us, _ in slowest:
+            print("    %8.1f ms  %s" % (cumulative_us / 1000.0, name))
+        if args.max_ms is not None and stats['import_ms'] > args.max_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print("Over the %.0f ms budget: %s" % (args.max_ms,
+                                               ", ".join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import pandas as pd
+import pytest
+import batch_tools
+from batch_tools import SQLiteWorkQueue, make_units, keep_lease, run_worker
+
+METRICS = {'hdb_total': {'detector': 'hdb', 'min_size': 15, 'percent': 2}}
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+
+def make_queue(queue_path, **kwargs):
+    queue = SQLiteWorkQueue(queue_path, **kwargs)
+    queue.put(make_units(['AK', 'CA'], ['Cardiology'], METRICS))
+    return queue
+
+
+def test_unit_ids_follow_the_config():
+    units = make_units(['CA'], ['Cardiology'], METRICS)
+    assert units[0]['unit_id'] == \
+        "CA|Cardiology|hdb_total|hdb_min_size15_percent2"
+    edited = {'hdb_total': dict(METRICS['hdb_total'], min_size=20)}
+    assert make_units(['CA'], ['Cardiology'], edited)[0]['unit_id'] != \
+        units[0]['unit_id']
+
+
+def test_put_ignores_queued_units(queue_path):
+    queue = make_queue(queue_path)
+    queue.put(make_units(['CA'], ['Cardiology'], METRICS))
+    assert queue.status_counts() == {'pending': 2}
+
+
+def test_claim_until_empty(queue_path):
+    queue = make_queue(queue_path)
+    first = queue.claim('w1')
+    second = queue.claim('w2')
+    assert {first['state'], second['state']} == {'AK', 'CA'}
+    assert first['metric'] == 'hdb_total'
+    assert first['config'] == METRICS['hdb_total']
+    assert queue.claim('w3') is None
+    assert queue.status_counts() == {'running': 2}
+
+
+def test_only_the_holder_can_finish_a_unit(queue_path):
+    queue = make_queue(queue_path)
+    unit = queue.claim('w1')
+    queue.complete(unit['unit_id'], 'w2')
+    assert not queue.renew(unit['unit_id'], 'w2')
+    assert queue.status_counts() == {'pending': 1, 'running': 1}
+    assert queue.renew(unit['unit_id'], 'w1')
+    queue.complete(unit['unit_id'], 'w1')
+    assert queue.status_counts() == {'pending': 1, 'done': 1}
+
+
+def test_failed_unit_waits_before_retry(queue_path):
+    queue = make_queue(queue_path, retry_seconds=3600)
+    unit = queue.claim('w1')
+    queue.fail(unit['unit_id'], 'w1', "boom")
+    # The other unit is handed out, but the failed one is still backing off.
+    assert queue.claim('w1')['unit_id'] != unit['unit_id']
+    assert queue.claim('w1') is None
+    assert queue.status_counts() == {'pending': 1, 'running': 1}
+
+
+def test_fresh_units_go_before_retries(queue_path):
+    queue = make_queue(queue_path, retry_seconds=0)
+    unit = queue.claim('w1')
+    queue.fail(unit['unit_id'], 'w1', "boom")
+    assert queue.claim('w1')['unit_id'] != unit['unit_id']
+    assert queue.claim('w1')['unit_id'] == unit['unit_id']
+
+
+def test_unit_fails_after_max_attempts(queue_path):
+    queue = make_queue(queue_path, max_attempts=2, retry_seconds=0)
+    queue.put(make_units(['CA'], ['Cardiology'], METRICS))
+    for _ in range(2):
+        unit = queue.claim('w1')
+        while unit['state'] != 'CA':
+            queue.complete(unit['unit_id'], 'w1')
+            unit = queue.claim('w1')
+        queue.fail(unit['unit_id'], 'w1', "boom")
+    assert queue.status_counts() == {'done': 1, 'failed': 1}
+    assert queue.claim('w1') is None
+
+
+def test_expired_lease_is_taken_over(queue_path):
+    queue = make_queue(queue_path, lease_seconds=0.01)
+    unit = queue.claim('w1')
+    queue.claim('w1')
+    time.sleep(0.05)
+    assert queue.claim('w2')['unit_id'] == unit['unit_id']
+    # The first worker can no longer renew, fail or complete it.
+    assert not queue.renew(unit['unit_id'], 'w1')
+    queue.fail(unit['unit_id'], 'w1', "late failure")
+    queue.complete(unit['unit_id'], 'w1')
+    assert queue.renew(unit['unit_id'], 'w2')
+    assert queue.status_counts() == {'running': 2}
+
+
+def test_expired_lease_out_of_attempts_fails(queue_path):
+    queue = make_queue(queue_path, lease_seconds=0.01, max_attempts=1)
+    queue.claim('w1')
+    queue.claim('w1')
+    time.sleep(0.05)
+    assert queue.claim('w2') is None
+    assert queue.status_counts() == {'failed': 2}
+
+
+def test_retry_and_reset(queue_path):
+    queue = make_queue(queue_path, max_attempts=1)
+    done = queue.claim('w1')
+    queue.complete(done['unit_id'], 'w1')
+    failed = queue.claim('w1')
+    queue.fail(failed['unit_id'], 'w1', "boom")
+    assert queue.status_counts() == {'done': 1, 'failed': 1}
+
+    assert queue.reset(('failed',)) == 1
+    assert queue.status_counts() == {'done': 1, 'pending': 1}
+    assert queue.claim('w2')['unit_id'] == failed['unit_id']
+
+    assert queue.reset() == 1
+    assert queue.status_counts() == {'pending': 1, 'running': 1}
+
+
+def test_keep_lease_renews_and_notices_loss(queue_path):
+    queue = make_queue(queue_path, lease_seconds=0.3)
+    lease_queue = SQLiteWorkQueue(queue_path, create_table=False,
+                                  lease_seconds=0.3)
+    unit = queue.claim('w1')
+    stop, lost = threading.Event(), threading.Event()
+    heartbeat = threading.Thread(target=keep_lease, args=(
+        lease_queue, unit['unit_id'], 'w1', stop, lost))
+    heartbeat.start()
+    time.sleep(0.5)
+    # Renewed past the original lease, so nobody else can take it over.
+    assert queue.claim('w2')['unit_id'] != unit['unit_id']
+    assert queue.claim('w2') is None
+
+    # Another worker steals the unit; the heartbeat gives up on it.
+    cursor = queue.connection.cursor()
+    cursor.execute("UPDATE scoring_units SET worker = 'w3' WHERE unit_id = ?",
+                   (unit['unit_id'],))
+    heartbeat.join(timeout=2)
+    assert lost.is_set()
+    stop.set()
+
+
+class FakeWriter:
+    """Records write_slice calls instead of writing to PostgreSQL."""
+
+    writes = []
+
+    def __init__(self, config_yaml):
+        pass
+
+    def write_slice(self, metric, state, specialty, counts_df):
+        self.writes.append((metric, state, specialty, len(counts_df)))
+
+
+def test_run_worker_writes_empty_slices_and_retries_failed_reads(
+        queue_path, monkeypatch):
+    class FakeReader:
+        def __init__(self, config_yaml, states, specialties, **kwargs):
+            if states == ['CA']:
+                raise RuntimeError("connection lost")
+            self.d_f = pd.DataFrame()
+
+    FakeWriter.writes = []
+    monkeypatch.setattr(batch_tools, 'OutlierCountDBWriter', FakeWriter)
+    monkeypatch.setattr(batch_tools, 'PandasDBReader', FakeReader)
+    make_queue(queue_path, retry_seconds=3600)
+    assert run_worker(queue_path, "config.yaml", worker_id='w1') == 1
+    # The empty AK slice is still replaced, and nothing is written for CA.
+    assert FakeWriter.writes == [('hdb_total', 'AK', 'Cardiology', 0)]
+    assert SQLiteWorkQueue(queue_path).status_counts() == \
+        {'done': 1, 'pending': 1}
+
+
+def test_run_worker_cancels_units_of_changed_partitions(queue_path,
+                                                        monkeypatch):
+    class VersionedWriter(FakeWriter):
+        def slice_fingerprint(self, region_list, specialty_list, year=None):
+            return "2:new"
+
+    class FakeReader:
+        def __init__(self, config_yaml, states, specialties, **kwargs):
+            self.d_f = pd.DataFrame()
+
+    FakeWriter.writes = []
+    monkeypatch.setattr(batch_tools, 'OutlierCountDBWriter', VersionedWriter)
+    monkeypatch.setattr(batch_tools, 'PandasDBReader', FakeReader)
+    queue = SQLiteWorkQueue(queue_path)
+    units = make_units(['CA'], ['Cardiology'], METRICS)
+    for fprint in ("1:old", "2:new"):
+        queue.put([dict(units[0], unit_id=fprint, year=2016,
+                        fingerprint=fprint)])
+    assert run_worker(queue_path, "config.yaml", worker_id='w1') == 1
+    assert FakeWriter.writes == [('hdb_total_2016', 'CA', 'Cardiology', 0)]
+    assert queue.status_counts() == {'cancelled': 1, 'done': 1}
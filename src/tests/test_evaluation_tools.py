@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import math
+import pandas as pd
+from evaluation_tools import precision_at_k, recall_at_k, \
+    average_precision, score_ranking, flagged_npis, cache_path
+
+
+def test_precision_at_k():
+    ranked = ['1', '2', '3', '4']
+    assert precision_at_k(ranked, {'1', '3'}, 2) == 0.5
+    # Fewer flagged providers than k are scored over all of them.
+    assert precision_at_k(['1'], {'1'}, 10) == 1.0
+    assert math.isnan(precision_at_k([], {'1'}, 10))
+
+
+def test_recall_at_k():
+    ranked = ['1', '2', '3', '4']
+    assert recall_at_k(ranked, {'1', '4'}, 2) == 0.5
+    assert recall_at_k(ranked, {'1', '4'}, 4) == 1.0
+    assert math.isnan(recall_at_k(ranked, set(), 2))
+
+
+def test_average_precision():
+    assert average_precision(['1', '2', '3'], {'1', '3'}) == \
+        (1.0 + 2.0 / 3.0) / 2
+    # A fraud case that was never flagged counts as zero.
+    assert average_precision(['1'], {'1', '9'}) == 0.5
+    assert math.isnan(average_precision(['1'], set()))
+
+
+def test_score_ranking_keys():
+    metrics = score_ranking(['1', '2'], {'2'}, k_list=[1, 5])
+    assert metrics['n_flagged'] == 2
+    assert metrics['n_fraud'] == 1
+    assert metrics['precision@1'] == 0.0
+    assert metrics['recall@5'] == 1.0
+
+
+def test_flagged_npis_drops_unflagged_providers():
+    ranked = pd.DataFrame({'outlier_count': [3, 1, 0, 0]},
+                          index=[30, 10, 20, 40])
+    assert flagged_npis(ranked) == ['30', '10']
+
+
+def test_cache_path_depends_on_data_version():
+    det_config = {'detector': 'hdb', 'min_size': 15}
+    old = cache_path("cache", "CA", "Internal Medicine", det_config, "abc")
+    new = cache_path("cache", "CA", "Internal Medicine", det_config, "def")
+    assert old != new
+    assert " " not in old
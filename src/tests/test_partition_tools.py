@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pandas as pd
+import pytest
+import partition_tools
+from partition_tools import PartitionStore, summarize_providers
+
+# The "database": claims per (year, state, specialty), versioned by a counter.
+TABLES = {}
+
+
+def claims(npis, counts):
+    return pd.DataFrame({'npi': npis, 'line_srvc_cnt': counts,
+                         'average_medicare_payment_amt': [10.0] * len(npis)})
+
+
+class FakeReader:
+    """Answers fingerprint queries from TABLES instead of PostgreSQL."""
+
+    def __init__(self, config_yaml):
+        self.configuration = {'year_tables': {2015: 'cms_2015',
+                                              2016: 'cms_2016'}}
+
+    def slice_fingerprint(self, region_list, specialty_list, year=None):
+        return "1:" + str(TABLES[(year, region_list[0], specialty_list[0])][0])
+
+
+class FakePandasReader:
+    """Reads claims from TABLES, counting the reads."""
+
+    reads = 0
+
+    def __init__(self, config_yaml, region_list, specialty_list, **kwargs):
+        FakePandasReader.reads += 1
+        key = (kwargs['year'], region_list[0], specialty_list[0])
+        self.d_f = TABLES[key][1]
+        # Allows a test to reload the table while it is being read.
+        if len(TABLES[key]) > 2:
+            TABLES[key] = TABLES[key][2]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(partition_tools, 'CMSDBReader', FakeReader)
+    monkeypatch.setattr(partition_tools, 'PandasDBReader', FakePandasReader)
+    FakePandasReader.reads = 0
+    TABLES.clear()
+    TABLES[(2015, 'CA', 'Cardiology')] = (1, claims([1, 2], [10, 20]))
+    TABLES[(2016, 'CA', 'Cardiology')] = (1, claims([1, 3], [15, 5]))
+    return PartitionStore("config.yaml", str(tmp_path))
+
+
+def test_summarize_providers():
+    summary = summarize_providers(claims([1, 1, 2], [1, 2, 3]))
+    assert list(summary.index) == ['1', '2']
+    assert list(summary['num_proc']) == [2, 1]
+    assert list(summary['payment']) == [30.0, 30.0]
+
+
+def test_load_reads_each_version_once(store):
+    store.load(2016, 'CA', 'Cardiology')
+    store.load(2016, 'CA', 'Cardiology')
+    assert FakePandasReader.reads == 1
+    TABLES[(2016, 'CA', 'Cardiology')] = (2, claims([1], [7]))
+    assert list(store.load(2016, 'CA', 'Cardiology')['npi']) == [1]
+    assert FakePandasReader.reads == 2
+    # Only the claims and summary of the current version are kept.
+    assert sorted(os.listdir(store.cache_dir)) == \
+        ['2016_CA_Cardiology_1-2_claims.pkl',
+         '2016_CA_Cardiology_1-2_summary.pkl']
+
+
+def test_load_rejects_stale_fingerprint(store):
+    with pytest.raises(ValueError):
+        store.load(2016, 'CA', 'Cardiology', fingerprint="1:0")
+    # Nothing was cached under either version.
+    store.load(2016, 'CA', 'Cardiology')
+    assert FakePandasReader.reads == 2
+
+
+def test_load_rejects_reload_during_read(store):
+    TABLES[(2016, 'CA', 'Cardiology')] = (1, claims([1], [1]),
+                                          (2, claims([1], [2])))
+    with pytest.raises(ValueError):
+        store.load(2016, 'CA', 'Cardiology')
+    assert list(store.load(2016, 'CA', 'Cardiology')['line_srvc_cnt']) == [2]
+
+
+def test_trend_features_follow_reloads(store):
+    trend = store.trend_features(2016, 'CA', 'Cardiology')
+    assert trend.loc['1', 'srvc_cnt_yoy_change'] == 5
+    assert pd.isnull(trend.loc['3', 'srvc_cnt_prev'])
+
+    # Reloading the previous year must not leave a stale summary behind.
+    TABLES[(2015, 'CA', 'Cardiology')] = (2, claims([1, 3], [5, 5]))
+    trend = store.trend_features(2016, 'CA', 'Cardiology')
+    assert trend.loc['1', 'srvc_cnt_yoy_change'] == 10
+    assert trend.loc['3', 'srvc_cnt_yoy_pct'] == 0
+
+
+def test_trend_features_without_previous_year(store):
+    TABLES[(2015, 'CA', 'Cardiology')] = (1, claims([1], [1]))
+    trend = store.trend_features(2015, 'CA', 'Cardiology')
+    assert trend['srvc_cnt_yoy_change'].isnull().all()
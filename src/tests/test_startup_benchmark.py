@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from startup_benchmark import parse_importtime, measure_module
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       227 |        227 |   _io
+import time:       472 |       1237 | _frozen_importlib_external
+import time:        50 |         50 |     encodings.aliases
+import time:       300 |        350 |   encodings
+import time:       100 |        450 | json
+"""
+
+
+def test_parse_importtime_depths():
+    records = parse_importtime(IMPORTTIME_OUTPUT)
+    assert records == [('_io', 227, 227, 1),
+                       ('_frozen_importlib_external', 472, 1237, 0),
+                       ('encodings.aliases', 50, 50, 2),
+                       ('encodings', 300, 350, 1),
+                       ('json', 100, 450, 0)]
+
+
+def test_parse_importtime_ignores_other_lines():
+    assert parse_importtime("Traceback (most recent call last):\n") == []
+
+
+def test_measure_module_finds_target():
+    stats = measure_module('json')
+    assert stats['module'] == 'json'
+    assert stats['import_ms'] > 0
+    assert stats['max_rss_mb'] > 0
+    assert all(rec[3] == 1 for rec in stats['dependencies'])